@@ -1,64 +1,135 @@
-import re
+import array
 import keyword
+import operator
+import functools
 import subprocess
 
 #Lexer definitions
 KEYWORDS = set(keyword.kwlist)
-OPERATORS = sorted([
+OPERATORS = {
     '**=', '//=', '==', '!=', '<=', '>=', '**', '//',
     '+=', '-=', '*=', '/=', '%=', '=', '<', '>', '+', '-', '*', '/', '%',
     'and', 'or', 'not', 'is', 'in'
-],
-key = lambda x: -len(x)) #sorts by length to match the longest operator first
+}
+
+#Token kinds, packed as small ints so the parser compares integers rather than strings
+K_STRING, K_FLOAT, K_INT, K_IDENT, K_KEYWORD, K_OP, K_MISMATCH = range(7)
+KIND_NAMES = ('STRING', 'FLOAT', 'INTEGER', 'IDENT', 'KEYWORD', 'OP', 'MISMATCH')
+
+#Character classes and operator tables for the hand written scanner
+_DIGITS = frozenset('0123456789')
+_IDENT_START = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_')
+_IDENT_CHARS = _IDENT_START | _DIGITS
+_NUMBER_START = _DIGITS | frozenset('+-.')
+_SPACE = frozenset(c for c in map(chr, range(128)) if c.isspace())
+_OP_BY_FIRST = {} #symbolic operators keyed by first character, longest first
+for _op in sorted((op for op in OPERATORS if not op.isalpha()), key = lambda x: -len(x)):
+    _OP_BY_FIRST.setdefault(_op[0], []).append(_op)
+
+def _match_number(line, i, n): #matches an optionally signed integer or float, returns (end, kind) or (i, None)
+    start = i + 1 if line[i] in '+-' else i
+    j = start
+    while(j < n and (line[j] in _DIGITS or (line[j] > '\x7f' and line[j].isdecimal()))): j += 1 #like the old \d, any unicode decimal digit
+    if(j < n and line[j] == '.'): #a fractional part makes it a float
+        k = j + 1
+        while(k < n and (line[k] in _DIGITS or (line[k] > '\x7f' and line[k].isdecimal()))): k += 1
+        if(j > start or k > j + 1): return k, K_FLOAT
+    if(j > start): return j, K_INT
+    return i, None
 
 #Tokenizer
-def tokenise_python_code(line): #converts a line of python source code into a list 
-    line = re.sub(r'#.*', '', line) #removes python comments
-    token_spec = [ #defines token patterns
-        ('STRING',   r'(".*?"|\'.*?\')'), #double or single quoted strings
-        ('FLOAT',    r'[+-]?(\d+\.\d*|\.\d+)'), #floating point literals
-        ('INTEGER',  r'[+-]?\d+'), #integer literals
-        ('IDENT',    r'[A-Za-z_][A-Za-z0-9_]*'), #identifiers
-        ('OP',       '|'.join(map(re.escape, OPERATORS))), #operators
-        ('SKIP',     r'\s+'), #whitetspace
-        ('MISMATCH', r'.'), #other single characters
-    ]
-    #compiles combined regex with named groups
-    tok_regex = '|'.join(f'(?P<{name}>{pattern})' for name, pattern in token_spec)
-    tokens = []
-    for mo in re.finditer(tok_regex, line): #iterates over all the matches in a line
-        kind, val = mo.lastgroup, mo.group()
-        if(kind == 'SKIP'): continue #ignores whitespace
-        if(kind == 'IDENT'):
-            if(val in KEYWORDS): kind = 'KEYWORD' #reclassify identifiers as KEYWORD or OP if they match
-            elif(val in OPERATORS): kind = 'OP'
-        tokens.append((val, kind))
-    return tokens
+def tokenise_python_code(line): #converts a line of python source code into a list of token values and an array of kinds
+    vals, kinds = _tokenise_cached(line)
+    return list(vals), array.array('b', kinds)
+
+@functools.lru_cache(maxsize=4096)
+def _tokenise_cached(line): #tokenises each distinct line once, tuples keep the cached result immutable
+    vals, kinds = [], []
+    i, n = 0, len(line)
+    while(i < n): #walks the line one token at a time
+        ch = line[i]
+        if(ch in _SPACE or (ch > '\x7f' and ch.isspace())): #ignores whitespace, unicode spaces included
+            i += 1
+            continue
+        if(ch == '#'): #a comment runs to the end of the line, like the old '#.*'
+            i = line.find('\n', i)
+            if(i == -1): break
+            continue
+        if(ch in _NUMBER_START or (ch > '\x7f' and ch.isdecimal())): #numbers, with an optional leading sign
+            j, kind = _match_number(line, i, n)
+            if(kind is not None):
+                vals.append(line[i:j])
+                kinds.append(kind)
+                i = j
+                continue
+        if(ch in _IDENT_START): #identifiers, reclassified as KEYWORD or OP if they match
+            j = i + 1
+            while(j < n and line[j] in _IDENT_CHARS): j += 1
+            val = line[i:j]
+            kind = K_KEYWORD if val in KEYWORDS else K_OP if val in OPERATORS else K_IDENT
+        elif(ch == '"' or ch == "'"): #double or single quoted strings, which never span a newline
+            j = line.find(ch, i + 1) + 1
+            if(j and line.find('\n', i + 1, j) == -1): val, kind = line[i:j], K_STRING
+            else: j, val, kind = i + 1, ch, K_MISMATCH #unterminated quote
+        else: #operators, or other single characters
+            for op in _OP_BY_FIRST.get(ch, ()):
+                if(line.startswith(op, i)):
+                    j, val, kind = i + len(op), op, K_OP
+                    break
+            else: j, val, kind = i + 1, ch, K_MISMATCH
+        vals.append(val)
+        kinds.append(kind)
+        i = j
+    return tuple(vals), tuple(kinds)
 
 # AST nodes
-class Node: pass
+class Node: __slots__ = ()
 class Number(Node): #integer literal
+    __slots__ = ('value',)
     def __init__(self, v): self.value = int(v)
 class String(Node): #string literal
+    __slots__ = ('value',)
     def __init__(self, v): self.value = v[1:-1]
 class Var(Node): #variable reference
+    __slots__ = ('name',)
     def __init__(self, n): self.name = n
 class BinOp(Node): #bianry operation
+    __slots__ = ('left', 'op', 'right')
     def __init__(self, l, o, r): self.left, self.op, self.right = l, o, r
 class Assign(Node): #variable assignment
+    __slots__ = ('name', 'expr')
     def __init__(self, n, e): self.name, self.expr = n, e
 class Print(Node): #print statements
+    __slots__ = ('expr',)
     def __init__(self, e): self.expr = e
 class If(Node): #single statement if statement
+    __slots__ = ('cond', 'body')
     def __init__(self, c, b): self.cond, self.body = c, b
 
+_BINOPS = { #python semantics for each binary operator
+    '+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.floordiv, '%': operator.mod
+}
+
+_C_INT_MIN, _C_INT_MAX = -(2**31 - 1), 2**31 - 1 #C ints that can be written as a literal; -2**31 would be -(2147483648), a long
+
+def _binop(left, op, right): #builds a BinOp, folding it to a Number when both operands are constant
+    if(isinstance(left, Number) and isinstance(right, Number)):
+        l, r = left.value, right.value
+        if(op in ('+', '-', '*') or (op in ('/', '%') and l >= 0 and r > 0)): #C and python only agree on / and % for non-negative operands
+            value = _BINOPS[op](l, r)
+            if(_C_INT_MIN <= value <= _C_INT_MAX): return Number(value) #anything wider would change the C literal's type
+    return BinOp(left, op, right)
+
 #Recursive Descent Parser
+_ADDOPS = frozenset(('+', '-'))
+_MULOPS = frozenset(('*', '/', '%'))
+
 class Parser:
-    def __init__(self, tokens):
-        self.toks = tokens
+    def __init__(self, vals, kinds): #token values and K_* kinds are kept in parallel sequences
+        self.vals, self.kinds = vals, kinds
         self.pos = 0
     def peek(self): #returns the current token or none at the end of stream
-        return self.toks[self.pos] if self.pos < len(self.toks) else (None, None)
+        return (self.vals[self.pos], self.kinds[self.pos]) if self.pos < len(self.vals) else (None, None)
     def advance(self): #takes current token
         self.pos += 1
     def expect(self, val): #checks that the current token matches val and then takes it
@@ -67,62 +138,69 @@ class Parser:
         self.advance()
     def parse(self): #parses statements until tokens are exhausted
         statements=[]
-        while(self.pos < len(self.toks)): statements.append(self.statement())
+        statement, n = self.statement, len(self.vals)
+        while(self.pos < n): statements.append(statement())
         return statements
 
     def statement(self): #parses a single statment such as print, assign, or if
-        t, typ = self.peek()
+        pos = self.pos
+        t, typ = (self.vals[pos], self.kinds[pos]) if pos < len(self.vals) else (None, None)
         if(t == 'print'):
-            self.advance()
+            self.pos = pos + 1
             self.expect('(')
             e = self.expr()
             self.expect(')')
             return Print(e)
-        if(typ == 'IDENT'):
-            name = t
-            self.advance()
+        if(typ == K_IDENT):
+            self.pos = pos + 1
             self.expect('=')
             e = self.expr()
-            return Assign(name, e)
+            return Assign(t, e)
         if(t == 'if'):
-            self.advance()
+            self.pos = pos + 1
             cond = self.expr()
             self.expect(':')
             body = self.statement()
             return If(cond, body)
         raise SyntaxError(f"Unexpected {t}")
 
+    #the loops below keep the position in a local and only sync self.pos around calls that consume tokens
     def expr(self): #expression handling + and -
-        node = self.term()
-        while(self.peek()[0] in ('+', '-')):
-            op = self.peek()[0]
-            self.advance()
-            right = self.term()
-            node = BinOp(node, op, right)
+        vals, kinds, term = self.vals, self.kinds, self.term
+        n = len(vals)
+        node = term()
+        pos = self.pos
+        while(pos < n and kinds[pos] == K_OP and vals[pos] in _ADDOPS):
+            self.pos = pos + 1
+            node = _binop(node, vals[pos], term())
+            pos = self.pos
         return node
 
     def term(self): #parses term handling *,/,%
-        node = self.factor()
-        while(self.peek()[0] in ('*', '/', '%')):
-            op = self.peek()[0]
-            self.advance()
-            right = self.factor()
-            node = BinOp(node, op, right)
+        vals, kinds, factor = self.vals, self.kinds, self.factor
+        n = len(vals)
+        node = factor()
+        pos = self.pos
+        while(pos < n and kinds[pos] == K_OP and vals[pos] in _MULOPS):
+            self.pos = pos + 1
+            node = _binop(node, vals[pos], factor())
+            pos = self.pos
         return node
 
     def factor(self): #parses integer, string, var, or parenthesised expression
-        t, typ = self.peek()
-        if(typ == 'INTEGER'):
-            self.advance()
+        pos = self.pos
+        t, typ = (self.vals[pos], self.kinds[pos]) if pos < len(self.vals) else (None, None)
+        if(typ == K_INT):
+            self.pos = pos + 1
             return Number(t)
-        if(typ == 'STRING'):
-            self.advance()
+        if(typ == K_STRING):
+            self.pos = pos + 1
             return String(t)
-        if(typ == 'IDENT'):
-            self.advance()
+        if(typ == K_IDENT):
+            self.pos = pos + 1
             return Var(t)
         if(t == '('):
-            self.advance()
+            self.pos = pos + 1
             node = self.expr()
             self.expect(')')
             return node
@@ -130,63 +208,178 @@ class Parser:
 
 #C code generator
 class CGen: #converts sample Python code to C
-    def __init__(self): self.lines = []
+    def __init__(self):
+        self.lines = []
+        self._keys, self._counts, self._temps = {}, {}, {}
+        self._sigs, self._found = {}, False
+        self._statements, self._names, self._ntemps = [], None, 0
     def gen(self, statements): #emits a C program from the abstract syntax tree
         self.lines = ['#include <stdio.h>', '', 'int main() {']
+        self._statements, self._names, self._ntemps = statements, None, 0
         for s in statements: self.emit(s)
         self.lines.append('    return 0;')
         self.lines.append('}')
         return '\n'.join(self.lines)
 
     def emit(self, node): #appends C code lines for a single AST node
-        if(isinstance(node, Assign)):
-            expr = self.e(node.expr)
-            self.lines.append(f'    int {node.name} = {expr};')
-        elif(isinstance(node, Print)):
-            expr = self.e(node.expr)
-            self.lines.append(f'    printf("%d\\n", {expr});')
-        elif(isinstance(node, If)):
-            cond = self.e(node.cond)
-            self.lines.append(f'    if ({cond}) {{')
-            self.emit(node.body)
-            self.lines.append('    }')
-
-    def e(self, node): #recursively generates C expressions from AST nodes
-        if(isinstance(node, Number)): return str(node.value)
-        if(isinstance(node, Var)): return node.name
-        if(isinstance(node, BinOp)):
-            left = self.e(node.left)
-            right = self.e(node.right)
-            return f'({left} {node.op} {right})'
+        handler = self._emit_dispatch.get(type(node))
+        if(handler): handler(self, node)
+
+    def _emit_assign(self, node): self._emit_line(['    int ', node.name, ' = '], node.expr, ';')
+    def _emit_print(self, node): self._emit_line(['    printf("%d\\n", '], node.expr, ');')
+    def _emit_if(self, node):
+        self._emit_line(['    if ('], node.cond, ') {')
+        self.emit(node.body)
+        self.lines.append('    }')
+
+    def _emit_line(self, prefix, expr, suffix): #appends one statement line, hoisting repeated subexpressions into temporaries
+        self._sigs, self._found = {}, False
+        out = list(prefix)
+        self.e(expr, out)
+        if(self._found): #rare: some subtree repeats, so key the statement and render it again with temporaries
+            self._cse(expr)
+            self._e_dispatch = self._e_cse_dispatch
+            out = list(prefix)
+            self.e(expr, out)
+            del self._e_dispatch #back to the class table
+        out.append(suffix)
+        self.lines.append(''.join(out))
+
+    #e() and its handlers return a structural key for the subtree: leaves use their C text, a BinOp a small int
+    def e(self, node, out): #recursively appends C expression fragments for an AST node to out, joined once per line
+        handler = self._e_dispatch.get(type(node))
+        if(handler): return handler(self, node, out)
+        out.append('0')
         return '0'
-    
+
+    def _e_number(self, node, out):
+        text = str(node.value)
+        out.append(text)
+        return text
+    def _e_var(self, node, out):
+        out.append(node.name)
+        return node.name
+    def _e_binop(self, node, out):
+        out.append('(')
+        left = self.e(node.left, out)
+        out.extend((' ', node.op, ' '))
+        right = self.e(node.right, out)
+        out.append(')')
+        sig, sigs = (node.op, left, right), self._sigs
+        key = sigs.get(sig)
+        if(key is None): key = sigs[sig] = len(sigs)
+        else: self._found = True #an equal subtree was already rendered in this statement
+        return key
+    def _e_binop_cse(self, node, out): #_e_binop for statements with repeats, computing each repeat once into a C temporary
+        key = self._keys[id(node)]
+        if(self._counts[key] < 2): return self._e_binop(node, out)
+        tmp = self._temps.get(key)
+        if(tmp is None):
+            frag = []
+            self._e_binop(node, frag)
+            tmp = self._temps[key] = self._new_temp()
+            self.lines.append(f'    int {tmp} = {"".join(frag)};')
+        out.append(tmp)
+        return key
+
+    def _new_temp(self): #names a C temporary that no variable in the program uses
+        if(self._names is None): self._names = _program_names(self._statements) #only collected once a temporary is needed
+        while(True):
+            name = f'__py2c_t{self._ntemps}'
+            self._ntemps += 1
+            if(name not in self._names): return name
+
+    def _cse(self, expr): #keys and counts the BinOp subtrees of a statement with repeats in one post order walk
+        keys, counts, self._temps = {}, {}, {}
+        self._keys, self._counts = keys, counts
+        sigs, leaves, kids = {}, {}, {} #(op, left key, right key) and leaf values -> small ints; BinOp key -> its BinOp children's keys
+        stack = [(expr, False)]
+        while(stack): #post order, so children are keyed before their parent
+            node, ready = stack.pop()
+            left, right = node.left, node.right
+            if(not ready):
+                stack.append((node, True))
+                if(type(right) is BinOp): stack.append((right, False))
+                if(type(left) is BinOp): stack.append((left, False))
+                continue
+            sub = []
+            for child in (left, right): #operand keys: a BinOp's small int, or a small int per distinct leaf value
+                kind = type(child)
+                if(kind is BinOp): sub.append(keys[id(child)])
+                else:
+                    leaf = child.value if kind is Number else child.name if kind is Var else None #anything else is emitted as 0
+                    k = leaves.get(leaf)
+                    if(k is None): k = leaves[leaf] = len(sigs) + len(leaves)
+                    sub.append(k)
+            sig = (node.op, sub[0], sub[1])
+            key = sigs.get(sig)
+            if(key is None):
+                key = sigs[sig] = len(sigs) + len(leaves)
+                kids[key] = [k for k, child in zip(sub, (left, right)) if type(child) is BinOp]
+            keys[id(node)] = key
+            seen = counts.get(key, 0)
+            counts[key] = seen + 1
+            if(seen): #a repeat's subtree is covered by its temporary, so its inner nodes were counted once too often
+                pending = list(kids[key])
+                while(pending):
+                    k = pending.pop()
+                    counts[k] -= 1
+                    pending.extend(kids[k])
+
+def _program_names(statements): #every variable the program declares, i.e. assigns, including inside if bodies
+    names = set()
+    for node in statements:
+        while(type(node) is If): node = node.body
+        if(type(node) is Assign): names.add(node.name)
+    return names
+
+#handlers keyed by node type, so dispatch is one dict lookup instead of an isinstance chain
+CGen._emit_dispatch = {Assign: CGen._emit_assign, Print: CGen._emit_print, If: CGen._emit_if}
+CGen._e_dispatch = {Number: CGen._e_number, Var: CGen._e_var, BinOp: CGen._e_binop}
+CGen._e_cse_dispatch = {**CGen._e_dispatch, BinOp: CGen._e_binop_cse}
+
 class Interpreter: #interpreter that executes the AST
     def __init__(self): self.env = {}
     def eval(self, node):
-        if isinstance(node, Number): return node.value #integer literal
-        if isinstance(node, Var): return self.env.get(node.name) #variable lookup
-        if isinstance(node, BinOp): #binary operations
-            l, r = self.eval(node.left), self.eval(node.right)
-            if node.op == '+': return l + r
-            if node.op == '-': return l - r
-            if node.op == '*': return l * r
-            if node.op == '/': return l // r
-            if node.op == '%': return l % r
-        if isinstance(node, Assign): self.env[node.name] = self.eval(node.expr) #looks at right side for variable assignment
-        if isinstance(node, Print): print(self.eval(node.expr)) #prints outputs to console
-        if isinstance(node, If) and self.eval(node.cond): self.eval(node.body) #if condition stuff
+        handler = self._dispatch.get(type(node))
+        return handler(self, node) if handler else None
+
+    def _eval_num(self, node): return node.value #integer literal
+    def _eval_var(self, node): return self.env.get(node.name) #variable lookup
+    def _eval_binop(self, node): #binary operations
+        l, r = self.eval(node.left), self.eval(node.right)
+        fn = _BINOPS.get(node.op)
+        return fn(l, r) if fn else None
+    def _eval_assign(self, node): self.env[node.name] = self.eval(node.expr) #looks at right side for variable assignment
+    def _eval_print(self, node): print(self.eval(node.expr)) #prints outputs to console
+    def _eval_if(self, node): #if condition stuff
+        if self.eval(node.cond): self.eval(node.body)
+
+Interpreter._dispatch = {
+    Number: Interpreter._eval_num, Var: Interpreter._eval_var, BinOp: Interpreter._eval_binop,
+    Assign: Interpreter._eval_assign, Print: Interpreter._eval_print, If: Interpreter._eval_if
+}
 
 #Runner
+@functools.lru_cache(maxsize=64)
+def _compile_asm(c_code): #runs GCC once per distinct C source and reuses the assembly on later runs
+    return subprocess.run(['gcc', '-x', 'c', '-pipe', '-O0', '-S', '-o', '-', '-'],
+                          input=c_code.encode(), stdout=subprocess.PIPE, check=True).stdout
+
 def run_py2c(source): #tokenise, parse, generate C, and then invoke GCC to produce the assembly
-    toks, errs = [], []
+    vals, kinds, errs = [], array.array('b'), []
     for i, ln in enumerate(source, 1): #lex each line and then collect tokens and errors
-        try: toks.extend(tokenise_python_code(ln))
+        try:
+            line_vals, line_kinds = _tokenise_cached(ln)
+            vals.extend(line_vals)
+            kinds.extend(line_kinds)
         except Exception as e: errs.append(f'Line {i}: {e}')
-    statements = Parser(toks).parse() #build AST and generate C source
+    statements = Parser(vals, kinds).parse() #build AST and generate C source
     c_code = CGen().gen(statements)
     with(open('output.c', 'w') as f): f.write(c_code)
-    try: #invoke GCC to compile assembly
-        subprocess.run(['gcc', '-S', 'output.c', '-o', 'output.s'], check=True)
+    try: #invoke GCC to compile assembly, streaming the C source over stdin rather than rereading output.c
+        asm = _compile_asm(c_code)
+        with(open('output.s', 'wb') as f): f.write(asm)
         print('Wrote output.c and output.s')
     except subprocess.CalledProcessError as e: print('GCC failed:', e)
     interp = Interpreter()